@@ -26,9 +26,11 @@ import os
 import re
 
 GTSRB_ROOT_DIR = 'GTSRB'
+CACHE_DIR = os.path.join(GTSRB_ROOT_DIR, 'cache')
 
 TRAIN_ROOT_DIR = os.path.join(GTSRB_ROOT_DIR, 'Final_training')
 TRAIN_PKL_FILENAME = 'traffic_sign_train_dataset.pickle'
+TRAIN_MEMMAP_FILENAME = 'traffic_sign_train_bboxes.dat'
 TRAIN_SIZE = len([
     f
     for root, dirs, files in os.walk(os.path.join(TRAIN_ROOT_DIR, 'Images'))
@@ -24,107 +24,254 @@
 # -*- coding: utf-8 -*-
 
 import cv2
+import glob
+import hashlib
 import os
+import multiprocessing as mp
 import pandas as pd
-import re
 import joblib
 import numpy as np
 import model_sof as model
 import common
 
+try:
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+    prange = range
 
-def gt_csv_getline(gt_csvs):
-    for gt_csv in gt_csvs:
-        df = pd.io.parsers.read_csv(gt_csv, delimiter=';', skiprows=0)
-        n_lines = df.shape[0]
-        for i in range(n_lines):
-            img_file_path = os.path.join(
-                os.path.dirname(gt_csv), df.loc[i, 'Filename'])
-            # bbox include (Width;Height;Roi.X1;Roi.Y1;Roi.X2;Roi.Y2)
-            bbox = {
-                'Width': df.loc[i, 'Width'],
-                'Height': df.loc[i, 'Height'],
-                'Roi.X1': df.loc[i, 'Roi.X1'],
-                'Roi.Y1': df.loc[i, 'Roi.Y1'],
-                'Roi.X2': df.loc[i, 'Roi.X2'],
-                'Roi.Y2': df.loc[i, 'Roi.Y2']
-            }
-            classId = df.loc[i, 'ClassId']
-            yield (img_file_path, bbox, classId)
+try:
+    import lz4  # noqa: F401
+    PKL_COMPRESS = ('lz4', 1)
+except ImportError:
+    PKL_COMPRESS = ('zlib', 1)
 
+# Bump when the bbox decoding changes to invalidate cached bboxes
+GT_DECODE_VERSION = 2
 
-def get_gt_csvs(root_dir):
-    gt_csvs = [
-        os.path.join(root, f)
-        for root, dirs, files in os.walk(root_dir) for f in files
-        if re.search(r'.csv', f)
+
+def read_gt_csvs(gt_csvs):
+    dfs = [
+        pd.io.parsers.read_csv(gt_csv, delimiter=';', skiprows=0).assign(
+            _dir=os.path.dirname(gt_csv)) for gt_csv in gt_csvs
     ]
+    df = pd.concat(dfs, ignore_index=True)
+    img_file_paths = (df['_dir'] + os.sep + df['Filename']).to_numpy()
+    # bbox include (Width;Height;Roi.X1;Roi.Y1;Roi.X2;Roi.Y2)
+    bboxes = df[['Width', 'Height', 'Roi.X1', 'Roi.Y1', 'Roi.X2',
+                 'Roi.Y2']].to_numpy(dtype=np.int32)
+    classIds = df['ClassId'].to_numpy(dtype=np.int32)
+    return img_file_paths, bboxes, classIds
+
+
+def get_gt_csvs(root_dir):
+    gt_csvs = []
+    stack = [root_dir]
+    while stack:
+        d = stack.pop()
+        with os.scandir(d) as it:
+            for e in it:
+                if e.is_dir(follow_symlinks=False):
+                    stack.append(e.path)
+                elif e.name.lower().endswith('.csv'):
+                    gt_csvs.append(e.path)
     return gt_csvs
 
 
-def parse_gt_csv(gt_csvs, data_size):
+def _load_one(args):
+    img_file_path, bbox, idx = args
+    # Crop ground truth bounding box
+    img = cv2.imread(img_file_path)
+    gt_bbox = img[bbox[3]:bbox[5], bbox[2]:bbox[4]]
+
+    # Resize to same size
+    return idx, cv2.resize(gt_bbox, (model.IMG_WIDTH, model.IMG_HEIGHT))
+
+
+def gt_cache_key(gt_csvs, data_size):
+    key = [str(GT_DECODE_VERSION), str(data_size)]
+    key.append(
+        str((model.IMG_HEIGHT, model.IMG_WIDTH, model.IMG_CHANNELS)))
+    for gt_csv in sorted(gt_csvs):
+        st = os.stat(gt_csv)
+        key.append('{} {} {}'.format(gt_csv, st.st_size, st.st_mtime_ns))
+    return hashlib.sha1('\n'.join(key).encode()).hexdigest()
+
+
+def save_npy(fname, arr):
+    # Write to a temporary file first so an interrupted save is never used
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'wb') as f:
+        np.save(f, arr)
+    os.replace(tmp_fname, fname)
+
+
+def remove_stale_caches(train_or_test, keep_fnames):
+    pattern = os.path.join(common.CACHE_DIR, '{}_*.npy*'.format(train_or_test))
+    for fname in glob.glob(pattern):
+        if fname not in keep_fnames:
+            os.remove(fname)
+
+
+def parse_gt_csv(train_or_test, gt_csvs, data_size, get_pool):
+    # Reuse decoded bboxes of the same csv files if they are cached
+    key = gt_cache_key(gt_csvs, data_size)
+    bboxes_cache = os.path.join(
+        common.CACHE_DIR, '{}_{}_bboxes.npy'.format(train_or_test, key))
+    classIds_cache = os.path.join(
+        common.CACHE_DIR, '{}_{}_classIds.npy'.format(train_or_test, key))
+    if os.path.exists(bboxes_cache) and os.path.exists(classIds_cache):
+        return np.load(bboxes_cache, mmap_mode='r'), np.load(classIds_cache)
+
     bboxes = np.zeros(
         (data_size, model.IMG_HEIGHT, model.IMG_WIDTH, model.IMG_CHANNELS),
         dtype=np.uint8)
     classIds = np.zeros((data_size, 1), dtype=np.int32)
-    for i, (img_file_path, bbox,
-            classId) in enumerate(gt_csv_getline(gt_csvs)):
-        # Crop ground truth bounding box
-        img = cv2.imread(img_file_path)
-        gt_bbox = img[bbox['Roi.Y1']:bbox['Roi.Y2'], bbox['Roi.X1']:bbox[
-            'Roi.X2']]
-
-        # Resize to same size
-        gt_bbox = cv2.resize(gt_bbox, (model.IMG_WIDTH, model.IMG_HEIGHT))
-
-        # Expand dimension to stack image arrays
-        gt_bbox = np.expand_dims(gt_bbox, axis=0)
-
-        # Append bbox and classId
+    img_file_paths, gt_bboxes, gt_classIds = read_gt_csvs(gt_csvs)
+    args = zip(img_file_paths, gt_bboxes, range(len(img_file_paths)))
+    classIds[:len(gt_classIds), 0] = gt_classIds
+
+    # Decode, crop and resize in parallel
+    pool = get_pool()
+    for i, gt_bbox in pool.imap_unordered(_load_one, args, chunksize=64):
+        # Append bbox
         bboxes[i] = gt_bbox
-        classIds[i] = classId
+
+    if not os.path.exists(common.CACHE_DIR):
+        os.makedirs(common.CACHE_DIR)
+    remove_stale_caches(train_or_test, [bboxes_cache, classIds_cache])
+    save_npy(bboxes_cache, bboxes)
+    save_npy(classIds_cache, classIds)
     return bboxes, classIds
 
 
-def save_as_pickle(train_or_test, bboxes, classIds, pkl_fname, shuffle=False):
-    if shuffle:
-        shuffled_idx = np.random.permutation(len(bboxes))
-        save_bboxes = np.array(bboxes)[shuffled_idx]
-        save_classIds = np.array(classIds)[shuffled_idx]
-    else:
-        save_bboxes = np.array(bboxes)
-        save_classIds = np.array(classIds)
+def save_as_pickle(train_or_test, bboxes, classIds, pkl_fname):
+    save_bboxes = np.ascontiguousarray(bboxes)
+    save_classIds = np.ascontiguousarray(classIds)
 
     if train_or_test == 'train':
         save = {'train_bboxes': save_bboxes, 'train_classIds': save_classIds}
     else:
         save = {'test_bboxes': save_bboxes, 'test_classIds': save_classIds}
-    joblib.dump(save, pkl_fname, compress=5)
-
-
-def preproc(bboxes, classIds):
-    preproced_bboxes = np.zeros(bboxes.shape)
+    joblib.dump(save, pkl_fname, compress=PKL_COMPRESS)
+
+
+PREPROC_CHUNK_SIZE = 1024
+
+
+def _preproc_kernel(bboxes_u8, out_f32):
+    # Fixed point coefficients of OpenCV's 8-bit BGR <-> YCrCb conversion
+    shift = 14
+    half = 1 << (shift - 1)
+    n, h, w, _ = bboxes_u8.shape
+    for i in prange(n):
+        y = np.empty((h, w), dtype=np.int32)
+        cr = np.empty((h, w), dtype=np.int32)
+        cb = np.empty((h, w), dtype=np.int32)
+        hist = np.zeros(256, dtype=np.int64)
+        for r in range(h):
+            for c in range(w):
+                b = np.int32(bboxes_u8[i, r, c, 0])
+                g = np.int32(bboxes_u8[i, r, c, 1])
+                rr = np.int32(bboxes_u8[i, r, c, 2])
+                yv = (b * 1868 + g * 9617 + rr * 4899 + half) >> shift
+                y[r, c] = yv
+                crv = ((rr - yv) * 11682 + (128 << shift) + half) >> shift
+                cbv = ((b - yv) * 9241 + (128 << shift) + half) >> shift
+                cr[r, c] = min(max(crv, 0), 255)
+                cb[r, c] = min(max(cbv, 0), 255)
+                hist[yv] += 1
+
+        # Histogram equalization lookup table, rounded as cv2.equalizeHist
+        lut = np.empty(256, dtype=np.int32)
+        cdf_min = 0
+        for k in range(256):
+            if hist[k] > 0:
+                cdf_min = hist[k]
+                break
+        total = h * w
+        if total > cdf_min:
+            scale = np.float32(255.0) / np.float32(total - cdf_min)
+        else:
+            scale = np.float32(0.0)
+        cdf = 0
+        for k in range(256):
+            cdf += hist[k]
+            if total > cdf_min:
+                v = np.rint(np.float32(max(cdf - cdf_min, 0)) * scale)
+                lut[k] = min(np.int32(v), 255)
+            else:
+                lut[k] = k
+
+        # Back to BGR and scaling in [0, 1]
+        for r in range(h):
+            for c in range(w):
+                yv = lut[y[r, c]]
+                dcr = cr[r, c] - 128
+                dcb = cb[r, c] - 128
+                b = yv + ((dcb * 29049 + half) >> shift)
+                g = yv + ((dcr * -11698 + dcb * -5636 + half) >> shift)
+                rr = yv + ((dcr * 22987 + half) >> shift)
+                out_f32[i, r, c, 0] = min(max(b, 0), 255) / 255.
+                out_f32[i, r, c, 1] = min(max(g, 0), 255) / 255.
+                out_f32[i, r, c, 2] = min(max(rr, 0), 255) / 255.
+
+
+if HAS_NUMBA:
+    _preproc_kernel = njit(parallel=True)(_preproc_kernel)
+
+
+def _preproc_chunk(bboxes, out, start):
+    end = min(start + PREPROC_CHUNK_SIZE, len(bboxes))
 
     # Histogram equalization on color image
-    for i, bbox in enumerate(bboxes):
-        img = cv2.cvtColor(bbox, cv2.COLOR_BGR2YCrCb)
+    for i in range(start, end):
+        img = cv2.cvtColor(bboxes[i], cv2.COLOR_BGR2YCrCb)
         split_img = cv2.split(img)
         split_img[0] = cv2.equalizeHist(split_img[0])
         eq_img = cv2.merge(split_img)
         eq_img = cv2.cvtColor(eq_img, cv2.COLOR_YCrCb2BGR)
 
-        # Scaling in [0, 1]
-        eq_img = (eq_img / 255.).astype(np.float32)
+        # Scaling in [0, 1], cast straight into the float32 output
+        np.divide(eq_img, 255., out=out[i], casting='unsafe')
+
 
-        # Append bboxes
-        preproced_bboxes[i] = eq_img
+def preproc(bboxes, classIds, out=None):
+    if out is None:
+        preproced_bboxes = np.empty(bboxes.shape, dtype=np.float32)
+    else:
+        preproced_bboxes = out
+    if HAS_NUMBA:
+        _preproc_kernel(np.ascontiguousarray(bboxes), preproced_bboxes)
+        return preproced_bboxes, classIds
+
+    # Chunks of images in parallel, OpenCV releases the GIL
+    joblib.Parallel(n_jobs=-1, prefer='threads')(
+        joblib.delayed(_preproc_chunk)(bboxes, preproced_bboxes, start)
+        for start in range(0, len(bboxes), PREPROC_CHUNK_SIZE))
     return preproced_bboxes, classIds
 
 
+def flip_bboxes(src, flip_code):
+    if flip_code == 0:
+        # Reversing rows is a plain contiguous copy in NumPy
+        return np.ascontiguousarray(src[:, ::-1])
+    if flip_code == -1:
+        src = src[:, ::-1]
+    src = np.ascontiguousarray(src)
+    dst = np.empty_like(src)
+    if len(src) == 0:
+        return dst
+    # Mirroring columns is independent per row, so flip all images at once
+    n, h, w, ch = src.shape
+    cv2.flip(src.reshape(n * h, w, ch), 1, dst.reshape(n * h, w, ch))
+    return dst
+
+
 def aug_by_flip(bboxes, classIds):
-    aug_bboxes = np.zeros(
-        (0, bboxes.shape[1], bboxes.shape[2], bboxes.shape[3]), dtype=np.uint8)
-    aug_classIds = np.zeros((0, classIds.shape[1]), dtype=np.int32)
+    aug_bb_chunks = [bboxes]
+    aug_id_chunks = [classIds]
     n_classes = model.NUM_CLASSES
 
     # This classification is referenced to below.
@@ -147,82 +294,132 @@ def aug_by_flip(bboxes, classIds):
         [37, 36],
         [39, 38],
     ])
+    hflip_set = frozenset(hflip_cls.tolist())
+    vflip_set = frozenset(vflip_cls.tolist())
+    hvflip_set = frozenset(hvflip_cls.tolist())
+    changed_set = frozenset(hflip_cls_changed[:, 0].tolist())
+    remap = np.arange(n_classes, dtype=np.int32)
+    remap[hflip_cls_changed[:, 0]] = hflip_cls_changed[:, 1]
+
+    # Group sample indexes by classId in a single pass
+    ids = classIds.ravel()
+    order = np.argsort(ids, kind='stable')
+    counts = np.bincount(ids, minlength=n_classes)
+    offsets = np.concatenate(([0], counts.cumsum()))
 
     for c in range(n_classes):
-        idxes = np.where(classIds == c)[0]
+        idxes = order[offsets[c]:offsets[c + 1]]
         src = bboxes[idxes]
         srcIds = classIds[idxes]
 
-        if c in hflip_cls:
+        if c in hflip_set:
             # list of images(Ids) that flipped horizontally
-            dst = src[:, ::-1, :, :]
+            dst = flip_bboxes(src, 0)
             # append to bbox and classIds
-            aug_bboxes = np.append(aug_bboxes, dst, axis=0)
-            aug_classIds = np.append(aug_classIds, srcIds, axis=0)
-        if c in vflip_cls:
+            aug_bb_chunks.append(dst)
+            aug_id_chunks.append(srcIds)
+        if c in vflip_set:
             # list of images(Ids) that flipped vertically
-            dst = src[:, :, ::-1, :]
+            dst = flip_bboxes(src, 1)
             # append to bbox and classIds
-            aug_bboxes = np.append(aug_bboxes, dst, axis=0)
-            aug_classIds = np.append(aug_classIds, srcIds, axis=0)
-        if c in hvflip_cls:
+            aug_bb_chunks.append(dst)
+            aug_id_chunks.append(srcIds)
+        if c in hvflip_set:
             # list of images(Ids) that flipped horizontally and vertiaclly
-            dst = src[:, ::-1, :, :]
-            dst = dst[:, :, ::-1, :]
+            dst = flip_bboxes(src, -1)
             # append to bbox and classIds
-            aug_bboxes = np.append(aug_bboxes, dst, axis=0)
-            aug_classIds = np.append(aug_classIds, srcIds, axis=0)
-        if c in hflip_cls_changed[:, 0]:
-            dst = src[:, ::-1, :, :]
-            dstIds = np.asarray([
-                hflip_cls_changed[hflip_cls_changed[:, 0] == c][0][1]
-                for i in range(len(srcIds))
-            ])
+            aug_bb_chunks.append(dst)
+            aug_id_chunks.append(srcIds)
+        if c in changed_set:
+            dst = flip_bboxes(src, 0)
+            dstIds = remap[srcIds].reshape(-1, 1).astype(classIds.dtype)
             # append to bbox and classIds
-            aug_bboxes = np.append(aug_bboxes, dst, axis=0)
-            aug_classIds = np.append(
-                aug_classIds, np.expand_dims(dstIds, axis=1), axis=0)
-    return np.append(bboxes, aug_bboxes, axis=0), \
-        np.append(classIds, aug_classIds, axis=0)
+            aug_bb_chunks.append(dst)
+            aug_id_chunks.append(dstIds)
+    return np.concatenate(aug_bb_chunks, axis=0), \
+        np.concatenate(aug_id_chunks, axis=0)
+
+
+def one_hot(classIds):
+    n = len(classIds)
+    one_hot_classIds = np.zeros((n, model.NUM_CLASSES), dtype=np.float32)
+    one_hot_classIds[np.arange(n), classIds.ravel()] = 1.0
+    return one_hot_classIds
+
+
+def get_pool():
+    # Workers must not be forked from a process that may already run
+    # OpenCV's internal threads. forkserver imports this module once in the
+    # server and forks the workers from it, while spawn re-imports it (and
+    # tensorflow through model) in every worker.
+    if 'forkserver' in mp.get_all_start_methods():
+        ctx = mp.get_context('forkserver')
+    else:
+        ctx = mp.get_context('spawn')
+    return ctx.Pool(mp.cpu_count())
 
 
 def main():
     train_gt_csvs = get_gt_csvs(common.TRAIN_ROOT_DIR)
     test_gt_csvs = get_gt_csvs(common.TEST_ROOT_DIR)
 
-    train_bboxes, train_classIds = parse_gt_csv(train_gt_csvs,
-                                                common.TRAIN_SIZE)
-    test_bboxes, test_classIds = parse_gt_csv(test_gt_csvs, common.TEST_SIZE)
+    # Share one pool of decoding workers between train and test, started
+    # only when a bbox cache misses
+    pools = []
+
+    def get_shared_pool():
+        if not pools:
+            pools.append(get_pool())
+        return pools[0]
+
+    try:
+        train_bboxes, train_classIds = parse_gt_csv(
+            'train', train_gt_csvs, common.TRAIN_SIZE, get_shared_pool)
+        test_bboxes, test_classIds = parse_gt_csv(
+            'test', test_gt_csvs, common.TEST_SIZE, get_shared_pool)
+    finally:
+        for pool in pools:
+            pool.terminate()
     print('train dataset {}, labels {}'.format(train_bboxes.shape,
                                                train_classIds.shape))
     print('test dataset {}, labels {}'.format(test_bboxes.shape,
                                               test_classIds.shape))
 
-    # Preprocessing and apply data augmentation method
-    train_bboxes, train_classIds = preproc(train_bboxes, train_classIds)
-    print('train dataset(after preprocessing) {}, labels {}'.format(
-        train_bboxes.shape, train_classIds.shape))
-
-    # flip
+    # Apply data augmentation method on uint8 images and then preprocessing
     train_bboxes, train_classIds = aug_by_flip(train_bboxes, train_classIds)
     print(
         'train dataset(after data augmentation) {}'.format(len(train_bboxes)))
 
-    # Convert classIds to one hot vector
-    train_one_hot_classIds = np.eye(
-        model.NUM_CLASSES)[train_classIds.reshape(len(train_classIds))]
-    test_one_hot_classIds = np.eye(
-        model.NUM_CLASSES)[test_classIds.reshape(len(test_classIds))]
-
-    # Save bboxes and classIds as pickle
-    save_as_pickle(
-        'train',
-        train_bboxes,
-        train_one_hot_classIds,
-        common.TRAIN_PKL_FILENAME,
-        shuffle=True)
-    save_as_pickle('test', test_bboxes, test_one_hot_classIds,
-                   common.TEST_PKL_FILENAME)
+    # Shuffle uint8 images here, so the float32 set is never copied again
+    shuffled_idx = np.random.permutation(len(train_bboxes))
+    train_bboxes = np.take(train_bboxes, shuffled_idx, axis=0)
+    train_classIds = np.take(train_classIds, shuffled_idx, axis=0)
+
+    # Preprocessed images are backed by a memmap to cut peak RAM
+    train_bboxes_mm = np.memmap(
+        common.TRAIN_MEMMAP_FILENAME,
+        dtype=np.float32,
+        mode='w+',
+        shape=train_bboxes.shape)
+    try:
+        train_bboxes, train_classIds = preproc(
+            train_bboxes, train_classIds, out=train_bboxes_mm)
+        print('train dataset(after preprocessing) {}, labels {}'.format(
+            train_bboxes.shape, train_classIds.shape))
+
+        # Convert classIds to one hot vector
+        train_one_hot_classIds = one_hot(train_classIds)
+        test_one_hot_classIds = one_hot(test_classIds)
+
+        # Save bboxes and classIds as pickle
+        save_as_pickle('train', train_bboxes, train_one_hot_classIds,
+                       common.TRAIN_PKL_FILENAME)
+        save_as_pickle('test', test_bboxes, test_one_hot_classIds,
+                       common.TEST_PKL_FILENAME)
+    finally:
+        # Remove the temporary memmap file
+        train_bboxes = train_bboxes_mm = None
+        os.remove(common.TRAIN_MEMMAP_FILENAME)
 
 
 if __name__ == '__main__':